@@ -10,13 +10,19 @@ import re
 import shutil
 import subprocess
 import time
+from collections import deque
 from pathlib import Path
 
 import anthropic
 import httpx
 from dotenv import load_dotenv
-from telegram import Update
-from telegram.ext import Application, CommandHandler, MessageHandler, filters
+from telegram import InputFile, Update
+from telegram.ext import AIORateLimiter, Application, CommandHandler, MessageHandler, filters
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 load_dotenv()
 
@@ -38,6 +44,11 @@ HISTORY_FILE = BOT_DIR / ".history.json"
 DOWNLOADS_DIR = BOT_DIR / "downloads"
 MSG_LIMIT = 4000
 STATUS_THROTTLE = 3
+STATUS_TOOL_LINES = 80  # ~50 chars each keeps the tool log under MSG_LIMIT
+BUFFERED_UPLOAD_MAX = 10 * 1024 * 1024  # larger documents are streamed from disk
+UPLOAD_READ_TIMEOUT = 120.0  # Telegram can take a while to answer large uploads
+UPLOAD_CONCURRENCY = 4  # well below the Telegram connection pool size
+TYPING_INTERVAL = 4.5  # Telegram shows "typing" for ~5s per action
 
 TOKEN_URL = "https://api.anthropic.com/v1/oauth/token"
 CLIENT_ID = "9d1c250a-e61b-44d9-88ed-5944d1962f5e"
@@ -163,18 +174,26 @@ TOOLS = [
 def _short(s: str, n: int = 40) -> str:
     return s if len(s) <= n else "..." + s[-(n - 3):]
 
+# name -> (input key, default, template, _short width or None)
+_TOOL_TEMPLATES = {
+    "Read":      ("file_path", "?", "Reading {}", 40),
+    "Glob":      ("pattern", "files", "Searching for {}", None),
+    "Grep":      ("pattern", "...", 'Searching code for "{}"', None),
+    "Bash":      (None, None, "Running command", None),
+    "Write":     ("file_path", "?", "Writing {}", 40),
+    "Edit":      ("file_path", "?", "Editing {}", 40),
+    "WebFetch":  ("url", "?", "Fetching {}", 60),
+}
+
 def _describe_tool(name: str, inp: dict) -> str:
-    descs = {
-        "Read":      lambda i: f"Reading {_short(i.get('file_path', '?'))}",
-        "Glob":      lambda i: f"Searching for {i.get('pattern', 'files')}",
-        "Grep":      lambda i: f"Searching code for \"{i.get('pattern', '...')}\"",
-        "Bash":      lambda i: "Running command",
-        "Write":     lambda i: f"Writing {_short(i.get('file_path', '?'))}",
-        "Edit":      lambda i: f"Editing {_short(i.get('file_path', '?'))}",
-        "WebFetch":  lambda i: f"Fetching {_short(i.get('url', '?'), 60)}",
-    }
-    fn = descs.get(name)
-    return fn(inp) if fn else f"Using {name}"
+    spec = _TOOL_TEMPLATES.get(name)
+    if spec is None:
+        return f"Using {name}"
+    key, default, template, width = spec
+    if key is None:
+        return template
+    arg = inp.get(key, default)
+    return template.format(_short(arg, width) if width else arg)
 
 
 _bg_procs: list[subprocess.Popen] = []
@@ -182,30 +201,33 @@ _CREATE_NEW_PROCESS_GROUP = 0x00000200
 _CREATE_NO_WINDOW = 0x08000000
 
 
-def _run_bash_sync(cmd: str) -> str:
+async def _run_bash(cmd: str) -> str:
     """Run a bash command with proper process-tree cleanup on Windows."""
-    proc = subprocess.Popen(
-        ["bash", "-c", cmd],
-        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-        stdin=subprocess.DEVNULL, text=True,
+    proc = await asyncio.create_subprocess_exec(
+        "bash", "-c", cmd,
+        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+        stdin=asyncio.subprocess.DEVNULL,
         cwd=str(WORKSPACE),
         creationflags=_CREATE_NEW_PROCESS_GROUP | _CREATE_NO_WINDOW,
     )
     try:
-        stdout, stderr = proc.communicate(timeout=120)
-    except subprocess.TimeoutExpired:
-        subprocess.run(
-            ["taskkill", "/F", "/T", "/PID", str(proc.pid)],
-            capture_output=True, creationflags=_CREATE_NO_WINDOW,
+        stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout=120)
+    except asyncio.TimeoutError:
+        killer = await asyncio.create_subprocess_exec(
+            "taskkill", "/F", "/T", "/PID", str(proc.pid),
+            stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL,
+            creationflags=_CREATE_NO_WINDOW,
         )
+        await killer.wait()
         try:
-            proc.wait(timeout=5)
-        except subprocess.TimeoutExpired:
+            await asyncio.wait_for(proc.wait(), timeout=5)
+        except asyncio.TimeoutError:
             proc.kill()
         return "Command timed out after 120s"
-    out = stdout
+    # Match the universal-newline output Popen(text=True) used to give
+    out = stdout.decode("utf-8", errors="replace").replace("\r\n", "\n")
     if stderr:
-        out += ("\n" if out else "") + stderr
+        out += ("\n" if out else "") + stderr.decode("utf-8", errors="replace").replace("\r\n", "\n")
     if proc.returncode != 0:
         out += f"\n(exit code {proc.returncode})"
     return (out[:50000] if out else "(no output)").strip()
@@ -231,7 +253,7 @@ async def _tool_bash(inp: dict) -> str:
     try:
         if background:
             return await asyncio.to_thread(_run_bash_background, cmd)
-        return await asyncio.to_thread(_run_bash_sync, cmd)
+        return await _run_bash(cmd)
     except Exception as e:
         return f"Error: {e}"
 
@@ -340,17 +362,24 @@ async def _tool_webfetch(inp: dict) -> str:
         return f"Error fetching URL: {e}"
 
 
-async def _execute_tool(name: str, inp: dict) -> str:
-    dispatch = {
+# name -> (handler, is_async)
+_TOOL_DISPATCH = {
+    name: (fn, asyncio.iscoroutinefunction(fn))
+    for name, fn in {
         "Bash": _tool_bash, "Read": _tool_read, "Write": _tool_write,
         "Edit": _tool_edit, "Glob": _tool_glob, "Grep": _tool_grep,
         "WebFetch": _tool_webfetch,
-    }
-    fn = dispatch.get(name)
-    if not fn:
+    }.items()
+}
+
+
+async def _execute_tool(name: str, inp: dict) -> str:
+    entry = _TOOL_DISPATCH.get(name)
+    if not entry:
         return f"Unknown tool: {name}"
+    fn, is_async = entry
     try:
-        if asyncio.iscoroutinefunction(fn):
+        if is_async:
             return await fn(inp)
         return fn(inp)
     except Exception as e:
@@ -401,10 +430,20 @@ def _make_client(access_token: str) -> anthropic.AsyncAnthropic:
 
 # ── Conversation history ──
 
+def _json_dumps(obj) -> bytes:
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj)
+        except TypeError:
+            pass  # e.g. ints beyond 64 bits, which json handles
+    return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+_json_loads = orjson.loads if orjson is not None else json.loads
+
 def _load_history() -> list[dict]:
     if HISTORY_FILE.exists():
         try:
-            data = json.loads(HISTORY_FILE.read_text(encoding="utf-8"))
+            data = _json_loads(HISTORY_FILE.read_bytes())
             if isinstance(data, list):
                 return _sanitize_history(data)
         except (json.JSONDecodeError, OSError):
@@ -438,24 +477,23 @@ def _sanitize_history(history: list[dict]) -> list[dict]:
 
 MAX_TOKEN_EST = 150000  # leave headroom below 200k limit
 
-def _estimate_tokens(history: list[dict]) -> int:
-    """Rough token estimate: ~4 chars per token."""
+def _estimate_chars(msg: dict) -> int:
+    """Rough size of one message (~4 per token): text in chars, serialized blocks in UTF-8 bytes."""
     total = 0
-    for msg in history:
-        content = msg.get("content", "")
-        if isinstance(content, str):
-            total += len(content)
-        elif isinstance(content, list):
-            for block in content:
-                if isinstance(block, dict):
-                    if block.get("type") == "text":
-                        total += len(block.get("text", ""))
-                    elif block.get("type") == "tool_use":
-                        total += len(json.dumps(block.get("input", {})))
-                    elif block.get("type") == "tool_result":
-                        c = block.get("content", "")
-                        total += len(c) if isinstance(c, str) else len(json.dumps(c))
-    return total // 4
+    content = msg.get("content", "")
+    if isinstance(content, str):
+        total += len(content)
+    elif isinstance(content, list):
+        for block in content:
+            if isinstance(block, dict):
+                if block.get("type") == "text":
+                    total += len(block.get("text", ""))
+                elif block.get("type") == "tool_use":
+                    total += len(_json_dumps(block.get("input", {})))
+                elif block.get("type") == "tool_result":
+                    c = block.get("content", "")
+                    total += len(c) if isinstance(c, str) else len(_json_dumps(c))
+    return total
 
 
 def _trim_history(history: list[dict]) -> list[dict]:
@@ -464,9 +502,15 @@ def _trim_history(history: list[dict]) -> list[dict]:
     if len(history) > max_msgs:
         history = history[-max_msgs:]
 
-    # Trim by estimated tokens — drop oldest pairs until under limit
-    while len(history) > 2 and _estimate_tokens(history) > MAX_TOKEN_EST:
-        history = history[2:]  # drop in pairs to keep user/assistant alignment
+    # Trim by estimated tokens — drop oldest pairs until under limit.
+    # Each message is sized once; dropping a pair just subtracts its cost.
+    sizes = [_estimate_chars(msg) for msg in history]
+    total = sum(sizes)
+    start = 0
+    while len(history) - start > 2 and total // 4 > MAX_TOKEN_EST:
+        total -= sizes[start] + sizes[start + 1]
+        start += 2  # drop in pairs to keep user/assistant alignment
+    history = history[start:]
 
     # Fix trailing orphans
     history = _sanitize_history(history)
@@ -487,7 +531,7 @@ def _trim_history(history: list[dict]) -> list[dict]:
     return history
 
 
-def _save_history(history: list[dict]):
+async def _save_history(history: list[dict]):
     MAX_SAVE = 2000
     cleaned = []
     for msg in history:
@@ -512,7 +556,7 @@ def _save_history(history: list[dict]):
             cleaned.append({"role": msg["role"], "content": content[:MAX_SAVE] + "...(truncated)"})
         else:
             cleaned.append(msg)
-    HISTORY_FILE.write_text(json.dumps(cleaned, ensure_ascii=False), encoding="utf-8")
+    await asyncio.to_thread(HISTORY_FILE.write_bytes, _json_dumps(cleaned))
 
 conversation_history: list[dict] = _load_history()
 msg_count = 0
@@ -545,24 +589,61 @@ def _file_to_content_blocks(path: Path) -> list[dict]:
     except Exception:
         return []
 
-# ── Owner guard ──
-
-def owner_only(func):
-    async def wrapper(update: Update, context):
-        if update.effective_user.id != OWNER_ID:
-            return
-        return await func(update, context)
-    return wrapper
+# ── Rate limiting ──
+
+class _RateLimiter(AIORateLimiter):
+    """AIORateLimiter that also paces private chats and never retries best-effort calls.
+
+    AIORateLimiter only limits per chat for groups, so requests to the owner's private
+    chat are spaced `private_chat_interval` apart here. Sleeping out a RetryAfter on a
+    status edit or typing action would stall the agent run for an update nobody needs.
+    """
+
+    _BEST_EFFORT_ENDPOINTS = frozenset({"editMessageText", "sendChatAction"})
+
+    def __init__(self, max_retries: int = 0, private_chat_interval: float = 1.0, **kwargs):
+        # The base class treats rate_limit_args=0 as "use the default", so keep its default
+        # at 0 and hand the retry budget to the endpoints that should get it
+        super().__init__(max_retries=0, **kwargs)
+        self._send_retries = max_retries
+        self._private_chat_interval = private_chat_interval
+        self._private_chat_next: dict[int, float] = {}
+
+    async def _pace_private_chat(self, chat_id: int):
+        # Reserve the next free slot before sleeping, so concurrent requests queue up in order
+        now = time.monotonic()
+        slot = max(now, self._private_chat_next.get(chat_id, 0.0))
+        self._private_chat_next[chat_id] = slot + self._private_chat_interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id")
+        if isinstance(chat_id, int) and chat_id > 0:
+            await self._pace_private_chat(chat_id)
+        if endpoint not in self._BEST_EFFORT_ENDPOINTS:
+            rate_limit_args = rate_limit_args or self._send_retries
+        return await super().process_request(
+            callback, args, kwargs, endpoint, data, rate_limit_args
+        )
 
 # ── Status editing ──
 
-async def _edit_status(msg, text: str):
+_last_status_edit = 0.0  # monotonic time of the last successful status edit
+
+async def _edit_status(msg, text: str, current: str | None = None) -> str | None:
+    """Edit the status message unless it already shows `text`. Returns the shown text."""
+    global _last_status_edit
     if len(text) > MSG_LIMIT:
         text = text[-MSG_LIMIT:]
+    if text == current:
+        return current
     try:
         await msg.edit_text(text)
     except Exception:
-        pass
+        return current
+    _last_status_edit = time.monotonic()
+    return text
 
 # ── Streaming Claude API with agentic tool loop ──
 
@@ -575,8 +656,9 @@ async def stream_claude(content_blocks: list, status_msg) -> tuple[str, list[str
     conversation_history = _trim_history(conversation_history)
 
     written_files = []
-    tool_log = []
+    tool_log = deque(maxlen=STATUS_TOOL_LINES)
     response_text = ""
+    status_text = status_msg.text
 
     for turn in range(MAX_TOOL_TURNS):
         access_token = await _get_access_token()
@@ -603,7 +685,7 @@ async def stream_claude(content_blocks: list, status_msg) -> tuple[str, list[str
                         if now - last_edit >= STATUS_THROTTLE:
                             preview = response_text[-300:] if len(response_text) > 300 else response_text
                             status = ("\n".join(tool_log) + "\n\n" + preview).strip() if tool_log else preview
-                            await _edit_status(status_msg, status)
+                            status_text = await _edit_status(status_msg, status, status_text)
                             last_edit = now
 
                 final_msg = await stream.get_final_message()
@@ -638,7 +720,7 @@ async def stream_claude(content_blocks: list, status_msg) -> tuple[str, list[str
 
         # If no tool use, we're done
         if final_msg.stop_reason != "tool_use":
-            _save_history(conversation_history)
+            await _save_history(conversation_history)
             log.info("Response: %d chars, %d tool turns", len(response_text), turn + 1)
             return response_text, written_files
 
@@ -650,7 +732,7 @@ async def stream_claude(content_blocks: list, status_msg) -> tuple[str, list[str
             desc = _describe_tool(block.name, block.input)
             tool_log.append(desc)
             log.info("Tool: %s", desc)
-            await _edit_status(status_msg, "\n".join(tool_log))
+            status_text = await _edit_status(status_msg, "\n".join(tool_log), status_text)
 
             result = await _execute_tool(block.name, block.input)
             tool_results.append({
@@ -663,7 +745,7 @@ async def stream_claude(content_blocks: list, status_msg) -> tuple[str, list[str
 
         conversation_history.append({"role": "user", "content": tool_results})
 
-    _save_history(conversation_history)
+    await _save_history(conversation_history)
     return response_text or "(max tool turns reached)", written_files
 
 
@@ -674,32 +756,68 @@ def _pop_failed_user_msg():
 
 # ── Outbound file sending ──
 
-async def _send_written_files(chat, written_files: list[str]):
-    seen = set()
-    for raw_path in written_files:
-        p = Path(raw_path).resolve()
-        if str(p) in seen or not p.exists():
-            continue
-        seen.add(str(p))
+async def _send_file(chat, p: Path):
+    try:
         size = p.stat().st_size
-        if size == 0:
-            continue
-        try:
-            if p.suffix.lower() in IMAGE_EXTENSIONS and size <= 10 * 1024 * 1024:
-                await chat.send_photo(photo=open(p, "rb"), caption=p.name)
-            elif size <= 50 * 1024 * 1024:
-                await chat.send_document(document=open(p, "rb"), filename=p.name)
-            log.info("Sent file: %s (%d bytes)", p.name, size)
-        except Exception:
-            log.exception("Failed to send file: %s", p.name)
+    except OSError:
+        return
+    if size == 0 or size > 50 * 1024 * 1024:
+        return
+    try:
+        if size <= BUFFERED_UPLOAD_MAX:
+            data = await asyncio.to_thread(p.read_bytes)
+            if p.suffix.lower() in IMAGE_EXTENSIONS:
+                await chat.send_photo(photo=data, caption=p.name, filename=p.name,
+                                      read_timeout=UPLOAD_READ_TIMEOUT)
+            else:
+                await chat.send_document(document=data, filename=p.name,
+                                         read_timeout=UPLOAD_READ_TIMEOUT)
+        else:
+            # Too big to buffer: httpx streams the open handle in 64 KiB reads. Those
+            # reads are synchronous and run on the event loop, trading memory for
+            # short blocking reads.
+            with p.open("rb") as f:
+                await chat.send_document(document=InputFile(f, filename=p.name, read_file_handle=False),
+                                         read_timeout=UPLOAD_READ_TIMEOUT)
+        log.info("Sent file: %s (%d bytes)", p.name, size)
+    except Exception:
+        log.exception("Failed to send file: %s", p.name)
+
+async def _send_written_files(chat, written_files: list[str]):
+    # dict.fromkeys dedups repeated raw paths; abspath + normcase then folds relative/absolute
+    # and (on Windows) differently-cased spellings together lexically, without resolve()'s
+    # per-component lstat calls. The first spelling seen is the one uploaded.
+    unique = {}
+    for raw_path in dict.fromkeys(written_files):
+        path = os.path.abspath(raw_path)
+        unique.setdefault(os.path.normcase(path), path)
+    # Uploads start in the order the files were written, a few at a time; _RateLimiter
+    # spaces their requests to the private chat 1s apart
+    slots = asyncio.Semaphore(UPLOAD_CONCURRENCY)
+    async def send(p: Path):
+        async with slots:
+            await _send_file(chat, p)
+    await asyncio.gather(*(send(Path(p)) for p in unique.values()))
+
+# ── Reply chunking ──
+
+def _iter_chunks(text: str, limit: int = MSG_LIMIT):
+    """Yield text in pieces of at most `limit` chars, preferring to break at a newline."""
+    start = 0
+    while start < len(text):
+        end = start + limit
+        if end < len(text):
+            cut = text.rfind("\n", end - limit // 10, end)
+            if cut > start:
+                end = cut + 1
+        yield text[start:end]
+        start = end
 
 # ── Handlers ──
 
-@owner_only
 async def cmd_start(update: Update, context):
     await update.message.reply_text("ClaudeLink online. Send me anything.")
 
-@owner_only
 async def cmd_clear(update: Update, context):
     global conversation_history, msg_count
     conversation_history = []
@@ -712,26 +830,23 @@ async def cmd_clear(update: Update, context):
         DOWNLOADS_DIR.mkdir(exist_ok=True)
     await update.message.reply_text("Session reset. Next message starts fresh.")
 
-@owner_only
 async def cmd_status(update: Update, context):
     await update.message.reply_text(
         f"Messages: {msg_count}\nHistory: {len(conversation_history)} entries\nModel: {MODEL}"
     )
 
-@owner_only
 async def handle_message(update: Update, context):
     global msg_count
     msg = update.message
     text = msg.text or msg.caption or ""
     content_blocks = []
 
+    downloads = []
     if msg.photo:
-        photo = msg.photo[-1]
-        path = await _download_telegram_file(photo)
-        content_blocks.extend(_file_to_content_blocks(path))
-
+        downloads.append(_download_telegram_file(msg.photo[-1]))
     if msg.document:
-        path = await _download_telegram_file(msg.document, msg.document.file_name)
+        downloads.append(_download_telegram_file(msg.document, msg.document.file_name))
+    for path in await asyncio.gather(*downloads):
         content_blocks.extend(_file_to_content_blocks(path))
 
     if text:
@@ -746,11 +861,21 @@ async def handle_message(update: Update, context):
 
     status_msg = await msg.reply_text("Working...")
 
-    typing = True
+    done = asyncio.Event()
     async def keep_typing():
-        while typing:
-            await msg.chat.send_action("typing")
-            await asyncio.sleep(4)
+        # A fresh status edit already shows activity, so only send "typing" when idle
+        while not done.is_set():
+            idle = time.monotonic() - _last_status_edit
+            if idle >= TYPING_INTERVAL:
+                try:
+                    await msg.chat.send_action("typing")
+                except Exception:
+                    pass
+                idle = 0.0
+            try:
+                await asyncio.wait_for(done.wait(), timeout=TYPING_INTERVAL - idle)
+            except asyncio.TimeoutError:
+                pass
     typing_task = asyncio.create_task(keep_typing())
 
     written_files = []
@@ -760,8 +885,13 @@ async def handle_message(update: Update, context):
         log.exception("Claude invocation failed")
         response = f"Error: {type(e).__name__}: check logs."
     finally:
-        typing = False
+        # Don't wait on an in-flight send_action; it's only a typing indicator
+        done.set()
         typing_task.cancel()
+        try:
+            await typing_task
+        except asyncio.CancelledError:
+            pass
 
     msg_count += 1
 
@@ -770,8 +900,7 @@ async def handle_message(update: Update, context):
     except Exception:
         pass
 
-    chunks = [response[i : i + MSG_LIMIT] for i in range(0, len(response), MSG_LIMIT)]
-    for chunk in chunks:
+    for chunk in _iter_chunks(response):
         try:
             await msg.reply_text(chunk, parse_mode="Markdown")
         except Exception:
@@ -785,12 +914,23 @@ async def handle_message(update: Update, context):
 def main():
     DOWNLOADS_DIR.mkdir(exist_ok=True)
     log.info("Starting ClaudeLink (model=%s, history=%d msgs)", MODEL, len(conversation_history))
-    app = Application.builder().token(TOKEN).build()
-    app.add_handler(CommandHandler("start", cmd_start))
-    app.add_handler(CommandHandler("clear", cmd_clear))
-    app.add_handler(CommandHandler("status", cmd_status))
+    app = (
+        Application.builder()
+        .token(TOKEN)
+        .rate_limiter(_RateLimiter(max_retries=3))
+        .connection_pool_size(16)
+        .pool_timeout(30.0)
+        .media_write_timeout(120.0)
+        .get_updates_connection_pool_size(2)
+        .build()
+    )
+    # Updates from anyone but the owner are dropped by the dispatcher
+    owner = filters.User(user_id=OWNER_ID)
+    app.add_handler(CommandHandler("start", cmd_start, filters=owner))
+    app.add_handler(CommandHandler("clear", cmd_clear, filters=owner))
+    app.add_handler(CommandHandler("status", cmd_status, filters=owner))
     app.add_handler(MessageHandler(
-        (filters.TEXT | filters.PHOTO | filters.Document.ALL) & ~filters.COMMAND,
+        owner & (filters.TEXT | filters.PHOTO | filters.Document.ALL) & ~filters.COMMAND,
         handle_message,
     ))
     app.run_polling(drop_pending_updates=True)